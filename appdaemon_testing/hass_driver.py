@@ -1,18 +1,24 @@
 import contextlib
+import heapq
+import itertools
 import uuid
 from datetime import datetime, timedelta
 from functools import wraps
+from types import MappingProxyType
 import logging
+import sys
 import unittest.mock as mock
 from collections import defaultdict
-from copy import copy
-from dataclasses import InitVar, dataclass, field
-from typing import Dict, Any, List, Callable, Union, Optional
-
-import appdaemon.plugins.hass.hassapi as hass
+from dataclasses import dataclass
+from typing import Dict, Any, List, Callable, Union, Optional, Tuple
 
 _LOGGER = logging.getLogger(__name__)
 
+# Attribute names are interned so listeners can be matched by identity
+_ALL = sys.intern("all")
+
+_ONE_US = timedelta(microseconds=1)
+
 
 def possible_side_effects_state_change(fn):
     """
@@ -22,13 +28,26 @@ def possible_side_effects_state_change(fn):
     @wraps(fn)
     def inner(self, *args, **kwargs):
         if self.update_states:
-            fn(self, *args, **kwargs)
+            return fn(self, *args, **kwargs)
 
     return inner
 
 
+def _run_offsets(start_offset: int, end_offset: int, frequency: int) -> range:
+    """
+    Offsets of all runs of a repeating scheduler falling within
+    [start_offset, end_offset]. `stop` of the returned range is the offset of
+    the following run.
+    """
+    first = -(-start_offset // frequency)
+    last = end_offset // frequency
+    return range(first * frequency, (last + 1) * frequency, frequency)
+
+
 @dataclass(frozen=True)
 class StateSpy:
+    __slots__ = ("callback", "attribute", "new", "old", "kwargs")
+
     callback: Callable
     attribute: Optional[str]
     new: Optional[str]
@@ -36,62 +55,77 @@ class StateSpy:
     kwargs: Any
 
 
-@dataclass
-class Scheduler:
-    start: datetime
-    frequency_sec: int
-    callback: Callable
-    kwargs: Any
-    run_count: int = field(init=False, default=0)
-    last_run: datetime = field(init=False, default=None)
-    is_canceled: bool = field(init=False, default=False)
-
-    def __post_init__(self):
-        self.last_run = self.start
-
-
 class HassDriver:
+    # (AppDaemon method, side-effect implementation) for every mocked method
+    _MOCK_SPECS = (
+        ("log", None),
+        ("error", None),
+        ("call_service", None),
+        ("cancel_timer", "_se_cancel_timer"),
+        ("timer_running", None),
+        ("get_state", "_se_get_state"),
+        ("listen_event", None),
+        ("fire_event", None),
+        ("listen_state", "_se_listen_state"),
+        ("notify", None),
+        ("run_at", "_se_run_at"),
+        ("run_once", "_se_run_at"),
+        ("run_in", "_se_run_in"),
+        ("run_at_sunrise", None),
+        ("run_at_sunset", None),
+        ("run_daily", "_se_run_daily"),
+        ("run_every", "_se_run_every"),
+        ("run_hourly", "_se_run_hourly"),
+        ("run_minutely", "_se_run_minutely"),
+        ("set_state", None),
+        ("time", "_se_time"),
+        ("datetime", "_se_datetime"),
+        ("date", "_se_date"),
+        ("turn_off", "_se_turn_off"),
+        ("turn_on", "_se_turn_on"),
+    )
+    _MOCK_SIDE_EFFECTS = dict(_MOCK_SPECS)
+
     def __init__(self, update_states: bool = True, base_date: Optional[datetime] = None):
         self._base_datetime = base_date if base_date is not None else datetime.now()
         self._current_datetime = self._base_datetime
         self._setup_active = False
-
-        self._mocks = dict(
-            log=mock.Mock(),
-            error=mock.Mock(),
-            call_service=mock.Mock(),
-            cancel_timer=mock.Mock(side_effect=self._se_cancel_timer),
-            timer_running=mock.Mock(),
-            get_state=mock.Mock(side_effect=self._se_get_state),
+        # Depth of nested batched_notifications blocks, only the outermost flushes
+        self._batch_depth = 0
+        # (entity, attribute) -> [first old value, last new value, kwargs]
+        self._batched_changes: Dict[Tuple[str, str], List[Any]] = {}
+        # entity -> state entry before its first change within the batch
+        self._batched_prev_states: Dict[str, Dict[str, Any]] = {}
+
+        self._mocks: Dict[str, mock.Mock] = {}
+        # Mocks without a side-effect that still need a fixed return value
+        self._mock_return_values = dict(
             # TODO(NW): Implement side-effect for listen_event
-            listen_event=mock.Mock(return_value=uuid.uuid4()),
-            fire_event=mock.Mock(),
-            listen_state=mock.Mock(side_effect=self._se_listen_state),
-            notify=mock.Mock(),
-            run_at=mock.Mock(side_effect=self._se_run_at),
-            run_once=mock.Mock(side_effect=self._se_run_at),
-            run_in=mock.Mock(side_effect=self._se_run_in),
-            run_at_sunrise=mock.Mock(),
-            run_at_sunset=mock.Mock(),
-            run_daily=mock.Mock(side_effect=self._se_run_daily),
-            run_every=mock.Mock(side_effect=self._se_run_every),
-            run_hourly=mock.Mock(side_effect=self._se_run_hourly),
-            run_minutely=mock.Mock(side_effect=self._se_run_minutely),
-            set_state=mock.Mock(),
-            time=mock.Mock(return_value=self.simulation_time.time()),
-            datetime=mock.Mock(return_value=self.simulation_time),
-            date=mock.Mock(return_value=self.simulation_time.date()),
-            turn_off=mock.Mock(side_effect=self._se_turn_off),
-            turn_on=mock.Mock(side_effect=self._se_turn_on),
+            listen_event=uuid.uuid4(),
         )
 
         self.update_states = update_states
 
         self._states: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"state": None})
-        self._state_spys: Dict[Union[str, None], List[StateSpy]] = defaultdict(
-            lambda: []
-        )
-        self._schedulers = {}
+        # Index of domain -> {entity: state entry} for domain-wide get_state calls.
+        # Entities must be created through _get_state_entry to be indexed.
+        self._states_by_domain: Dict[str, Dict[str, Dict[str, Any]]] = defaultdict(dict)
+        self._entity_domain_cache: Dict[str, str] = {}
+        self._state_spys: Dict[Union[str, None], List[StateSpy]] = {}
+        self._next_handle = 0
+        # Schedulers are kept as parallel lists indexed by registration order.
+        # Times are integer microseconds since the base datetime (see _to_us).
+        self._sched_freq_us: List[int] = []
+        self._sched_callback: List[Callable] = []
+        self._sched_kwargs: List[Dict[str, Any]] = []
+        self._sched_next_run_us: List[Optional[int]] = []
+        self._sched_canceled: List[bool] = []
+        self._handle_to_idx: Dict[str, int] = {}
+        # index -> start for schedulers registered with a non-datetime start (e.g.
+        # "07:00:00"). They can be registered, but not time travelled.
+        self._sched_unresolved_starts: Dict[int, Any] = {}
+        # Min-heap of (next_run_us, index), canceled entries are dropped lazily
+        self._schedulers: List[Tuple[int, int]] = []
 
     @property
     def simulation_time(self):
@@ -102,28 +136,54 @@ class HassDriver:
         if new_datetime < self.simulation_time: raise ValueError(
             f"time travel is only possible to the future! You're trying to travel from {self.simulation_time} to {new_datetime}")
 
+        for i, start in self._sched_unresolved_starts.items():
+            if not self._sched_canceled[i]:
+                raise ValueError(
+                    "time travel only supports schedulers with a datetime start, "
+                    f"got {start!r}"
+                )
+
+        now_us = self._to_us(self.simulation_time)
+        new_us = self._to_us(new_datetime)
+
+        # Sorted runs of (run time, index, callback, kwargs) - the scheduler index
+        # runs callbacks due at the same time in registration order, without ever
+        # comparing the callbacks themselves. One-shot timers leave the heap in
+        # order, so they share a single run.
         callbacks_due = []
-        for s in self._schedulers.values():
-            if s.frequency_sec < 1 and (
-                    s.is_canceled or
-                    s.start < self.simulation_time or
-                    s.start > new_datetime or
-                    (s.start == self.simulation_time and s.run_count > 0)
-            ): continue
-
-            if s.frequency_sec < 1:
-                callbacks_due.append((s.start, s.callback, s.kwargs))
-                s.run_count += 1
-            else:
-                next_ = s.last_run
-                while next_ <= new_datetime:
-                    if next_ >= self.simulation_time:
-                        callbacks_due.append((next_, s.callback, s.kwargs))
-                        s.run_count += 1
-                        s.last_run = s.last_run + timedelta(seconds=s.frequency_sec)
-                    next_ = next_ + timedelta(seconds=s.frequency_sec)
-
-        for _, callback, kwargs in sorted(callbacks_due, key=lambda x: x[0]):
+        repeating_runs_due = []
+
+        # Bind everything used per popped scheduler to locals
+        schedulers = self._schedulers
+        heappop, heappush = heapq.heappop, heapq.heappush
+        canceled, freqs_us = self._sched_canceled, self._sched_freq_us
+        callbacks, kwargs_list = self._sched_callback, self._sched_kwargs
+        next_runs_us = self._sched_next_run_us
+        append_due = callbacks_due.append
+
+        while schedulers and schedulers[0][0] <= new_us:
+            next_run_us, i = heappop(schedulers)
+            if canceled[i]:
+                continue
+
+            freq_us = freqs_us[i]
+            callback, kwargs = callbacks[i], kwargs_list[i]
+            if freq_us < 1:
+                if next_run_us >= now_us:
+                    append_due((next_run_us, i, callback, kwargs))
+                continue
+
+            # Expand every run of a repeating scheduler up to new_datetime at once
+            offsets = _run_offsets(
+                max(0, now_us - next_run_us), new_us - next_run_us, freq_us
+            )
+            runs = [(next_run_us + offset, i, callback, kwargs) for offset in offsets]
+            if runs:
+                repeating_runs_due.append(runs)
+            next_runs_us[i] = next_run_us + offsets.stop
+            heappush(schedulers, (next_runs_us[i], i))
+
+        for _, _, callback, kwargs in heapq.merge(callbacks_due, *repeating_runs_due):
             callback(**kwargs)
 
         self._current_datetime = new_datetime
@@ -135,14 +195,30 @@ class HassDriver:
         Parameters:
             meth: The method to retreive the mock implementation for
         """
-        return self._mocks[meth]
+        m = self._mocks.get(meth)
+        if m is None:
+            m = self._build_mock(meth)
+            self._mocks[meth] = m
+        return m
+
+    def _build_mock(self, meth: str) -> mock.Mock:
+        side_effect = self._MOCK_SIDE_EFFECTS[meth]
+        if side_effect is not None:
+            return mock.Mock(side_effect=getattr(self, side_effect))
+        if meth in self._mock_return_values:
+            return mock.Mock(return_value=self._mock_return_values[meth])
+        return mock.Mock()
 
     def inject_mocks(self) -> None:
         """
         Monkey-patch the AppDaemon hassapi.Hass base-class methods with mock
         implementations.
         """
-        for meth_name, impl in self._mocks.items():
+        # Imported here so that importing the driver does not pull in AppDaemon
+        import appdaemon.plugins.hass.hassapi as hass
+
+        for meth_name, _ in self._MOCK_SPECS:
+            impl = self.get_mock(meth_name)
             if getattr(hass.Hass, meth_name) is None:
                 raise AssertionError("Attempt to mock non existing method: ", meth_name)
             _LOGGER.debug("Patching hass.Hass.%s", meth_name)
@@ -175,6 +251,68 @@ class HassDriver:
         yield None
         self._setup_active = False
 
+    @contextlib.contextmanager
+    def batched_notifications(self):
+        """
+        A context manager to defer `listen_state` handlers until the end of a
+        block of state changes.
+
+        State changes within this context manager are applied immediately, but
+        listeners are only notified when the context exits. Multiple changes of
+        the same entity attribute are coalesced into a single notification from
+        its first old value to its last new value, so listeners will not see
+        intermediate values. Listeners on `attribute="all"` are called once per
+        changed entity. Nested blocks are part of the outermost one, which is
+        where notifications are delivered. If the outermost block raises, the
+        pending notifications are discarded.
+
+        Example:
+
+        ```py
+        def test_my_app(hass_driver, my_app: MyApp):
+            with hass_driver.batched_notifications():
+                hass_driver.set_state("light.1", "on")
+                hass_driver.set_state("light.1", 50, attribute_name="brightness")
+                hass_driver.set_state("light.1", 80, attribute_name="brightness")
+
+            # Handlers were called once for "state" and once for "brightness"
+            ...
+        ```
+        """
+        self._batch_depth += 1
+        try:
+            yield None
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                # Taken here so that changes from a failed batch are dropped rather
+                # than delivered
+                changes, prev_states = self._batched_changes, self._batched_prev_states
+                self._batched_changes, self._batched_prev_states = {}, {}
+
+        if self._batch_depth:
+            return
+
+        # "all" listeners are called once per entity, on its first matching change
+        notified_all = set()
+        new_states = {}
+        for (entity, attribute_name), (old_value, new_value, kwargs) in changes.items():
+            if old_value == new_value:
+                continue
+            if entity not in new_states:
+                new_states[entity] = self._states[entity].copy()
+            self._notify_state_listeners(
+                entity,
+                self._entity_domain_cache[entity],
+                attribute_name,
+                old_value,
+                new_value,
+                prev_states[entity],
+                new_states[entity],
+                kwargs,
+                notified_all,
+            )
+
     def set_state(
             self, entity, state, *, attribute_name="state", previous=None, trigger=None, **kwargs
     ) -> None:
@@ -196,33 +334,100 @@ class HassDriver:
             # Avoid triggering state changes during state setup phase
             trigger = not self._setup_active
 
-        domain, _ = entity.split(".")
-        state_entry = self._states[entity]
-        prev_state = copy(state_entry)
-        old_value = previous or prev_state.get(attribute_name)
+        attribute_name = sys.intern(attribute_name)
+        domain = self._entity_domain(entity)
+        state_entry = self._get_state_entry(entity, domain)
+        old_value = previous or state_entry.get(attribute_name)
         new_value = state
 
         if old_value == new_value:
             return
 
-        # Update the state entry
-        state_entry[attribute_name] = new_value
+        if not trigger or (
+            domain not in self._state_spys and entity not in self._state_spys
+        ):
+            # Nobody to notify, just update the state entry
+            state_entry[attribute_name] = new_value
+            if self._batch_depth:
+                # Keep a pending batched notification in line with the actual state
+                pending = self._batched_changes.get((entity, attribute_name))
+                if pending is not None:
+                    pending[1] = new_value
+            return
 
-        if not trigger:
+        if self._batch_depth:
+            # Defer notification until the batch ends, keeping the first old value
+            if entity not in self._batched_prev_states:
+                self._batched_prev_states[entity] = state_entry.copy()
+            key = (entity, attribute_name)
+            if key in self._batched_changes:
+                self._batched_changes[key][1:] = [new_value, kwargs]
+            else:
+                self._batched_changes[key] = [old_value, new_value, kwargs]
+            state_entry[attribute_name] = new_value
             return
 
+        # Only "all" listeners need snapshots of the full state, which are taken
+        # once and shared between them
+        need_snapshot = any(
+            spy.attribute is _ALL
+            for spy in itertools.chain(
+                self._state_spys.get(domain, ()), self._state_spys.get(entity, ())
+            )
+        )
+        prev_state = state_entry.copy() if need_snapshot else None
+
+        # Update the state entry
+        state_entry[attribute_name] = new_value
+        new_state = state_entry.copy() if need_snapshot else None
+
         # Notify subscribers of the change
-        for spy in self._state_spys[domain] + self._state_spys[entity]:
-            sat_attr = spy.attribute == attribute_name or spy.attribute == "all"
-            sat_new = spy.new is None or spy.new == new_value
-            sat_old = spy.old is None or spy.old == old_value
+        self._notify_state_listeners(
+            entity, domain, attribute_name, old_value, new_value, prev_state, new_state,
+            kwargs,
+        )
 
-            param_old = prev_state if spy.attribute == "all" else old_value
-            param_new = copy(state_entry) if spy.attribute == "all" else new_value
-            param_attribute = None if spy.attribute == "all" else attribute_name
+    def _notify_state_listeners(
+            self, entity, domain, attribute_name, old_value, new_value, prev_state,
+            new_state, kwargs, notified_all: Optional[set] = None
+    ) -> None:
+        for spy in itertools.chain(
+            self._state_spys.get(domain, ()), self._state_spys.get(entity, ())
+        ):
+            spy_attribute, spy_new, spy_old = spy.attribute, spy.new, spy.old
+            listens_all = spy_attribute is _ALL
+            sat_attr = listens_all or spy_attribute is attribute_name
+            if not (
+                sat_attr
+                and (spy_new is None or spy_new == new_value)
+                and (spy_old is None or spy_old == old_value)
+            ):
+                continue
+
+            # Callbacks get read-only kwargs, so the listener's registration kwargs
+            # can be passed as is when set_state got no extra kwargs
+            spy_kwargs = spy.kwargs
+            if kwargs:
+                spy_kwargs = MappingProxyType(
+                    spy_kwargs | kwargs if spy_kwargs else kwargs
+                )
+            if listens_all:
+                if notified_all is not None:
+                    if (entity, id(spy)) in notified_all:
+                        continue
+                    notified_all.add((entity, id(spy)))
+                spy.callback(entity, None, prev_state, new_state, spy_kwargs)
+            else:
+                spy.callback(entity, attribute_name, old_value, new_value, spy_kwargs)
 
-            if all([sat_old, sat_new, sat_attr]):
-                spy.callback(entity, param_attribute, param_old, param_new, spy.kwargs | kwargs)
+    def _se_time(self):
+        return self._current_datetime.time()
+
+    def _se_datetime(self):
+        return self._current_datetime
+
+    def _se_date(self):
+        return self._current_datetime.date()
 
     @possible_side_effects_state_change
     def _se_turn_off(self, entity_id=None, **kwargs):
@@ -256,13 +461,32 @@ class HassDriver:
     def _se_run_in(self, callback: Callable, delay: int, **kwargs):
         return self._set_scheduler(self._current_datetime + timedelta(seconds=delay), 0, callback, **kwargs)
 
-    def _set_scheduler(self, start: datetime, frequency_sec: int, callback: Callable, **kwargs):
+    def _set_scheduler(
+            self, start: Union[datetime, str], frequency_sec: int, callback: Callable,
+            **kwargs
+    ):
         handle = str(uuid.uuid4())
-        self._schedulers[handle] = Scheduler(start, frequency_sec, callback, kwargs)
+        i = len(self._sched_freq_us)
+        start_us = self._to_us(start) if isinstance(start, datetime) else None
+        self._sched_freq_us.append(round(frequency_sec * 1_000_000))
+        self._sched_callback.append(callback)
+        self._sched_kwargs.append(kwargs)
+        self._sched_next_run_us.append(start_us)
+        self._sched_canceled.append(False)
+        self._handle_to_idx[handle] = i
+        if start_us is None:
+            self._sched_unresolved_starts[i] = start
+        else:
+            heapq.heappush(self._schedulers, (start_us, i))
         return handle
 
+    def _to_us(self, dt: datetime) -> int:
+        # Relative to the base datetime rather than the epoch, so naive datetimes
+        # are not shifted by the local timezone
+        return (dt - self._base_datetime) // _ONE_US
+
     def _se_cancel_timer(self, handle):
-        self._schedulers[handle].is_canceled = True
+        self._sched_canceled[self._handle_to_idx[handle]] = True
 
     def _se_get_state(self, entity_id=None, attribute="state", default=None, **kwargs):
         _LOGGER.debug("Getting state for entity: %s", entity_id)
@@ -270,12 +494,11 @@ class HassDriver:
         fully_qualified = "." in entity_id
         matched_states = {}
         if fully_qualified:
-            matched_states[entity_id] = self._states[entity_id]
+            matched_states[entity_id] = self._get_state_entry(
+                entity_id, self._entity_domain(entity_id)
+            )
         else:
-            for s_eid, state in self._states.items():
-                domain, entity = s_eid.split(".")
-                if domain == entity_id:
-                    matched_states[s_eid] = state
+            matched_states = dict(self._states_by_domain.get(entity_id, {}))
 
         # With matched states, map the provided attribute (if applicable)
         if attribute != "all":
@@ -293,15 +516,32 @@ class HassDriver:
         else:
             return matched_states
 
+    def _entity_domain(self, entity: str) -> str:
+        domain = self._entity_domain_cache.get(entity)
+        if domain is None:
+            domain, sep, rest = entity.partition(".")
+            if not sep or "." in rest:
+                raise ValueError(f"Invalid entity id: {entity!r}")
+            self._entity_domain_cache[entity] = domain
+        return domain
+
+    def _get_state_entry(self, entity: str, domain: str) -> Dict[str, Any]:
+        state_entry = self._states.get(entity)
+        if state_entry is None:
+            state_entry = self._states[entity]
+            self._states_by_domain[domain][entity] = state_entry
+        return state_entry
+
     def _se_listen_state(
             self, callback, entity=None, attribute=None, new=None, old=None, **kwargs
     ):
         spy = StateSpy(
             callback=callback,
-            attribute=attribute or "state",
+            attribute=sys.intern(attribute or "state"),
             new=new,
             old=old,
-            kwargs=kwargs,
+            kwargs=MappingProxyType(kwargs),
         )
-        self._state_spys[entity].append(spy)
-        return uuid.uuid4()
+        self._state_spys.setdefault(entity, []).append(spy)
+        self._next_handle += 1
+        return f"h{self._next_handle}"
@@ -7,6 +7,23 @@ from appdaemon_testing import HassDriver
 from appdaemon_testing.pytest import automation_fixture
 
 
+def test_get_mock_returns_same_instance_before_and_after_inject():
+    hass_driver = HassDriver()
+    log = hass_driver.get_mock("log")
+    assert hass_driver.get_mock("log") is log
+
+    hass_driver.inject_mocks()
+
+    assert hass_driver.get_mock("log") is log
+    assert hass.Hass.log is log
+
+
+def test_get_mock_unknown_method_raises():
+    hass_driver = HassDriver()
+    with pytest.raises(KeyError):
+        hass_driver.get_mock("not_a_hass_method")
+
+
 def test_get_state(hass_driver):
     get_state = hass_driver.get_mock("get_state")
     assert get_state("light.1") == "off"
@@ -54,6 +71,32 @@ def test_get_state_domain_with_default(hass_driver):
     }
 
 
+def test_get_state_domain_includes_new_entities():
+    hass_driver = HassDriver()
+    get_state = hass_driver.get_mock("get_state")
+    hass_driver.set_state("light.1", "off")
+    assert get_state("light") == {"light.1": "off"}
+
+    hass_driver.set_state("light.2", "on")
+    hass_driver.set_state("switch.1", "off")
+
+    assert get_state("light") == {"light.1": "off", "light.2": "on"}
+    assert get_state("switch") == {"switch.1": "off"}
+
+
+def test_get_state_domain_includes_entities_created_by_get_state(hass_driver):
+    get_state = hass_driver.get_mock("get_state")
+    assert get_state("light.3") is None
+
+    assert get_state("light") == {"light.1": "off", "light.2": "on", "light.3": None}
+
+
+@pytest.mark.parametrize("entity", ["light", "light.1.2"])
+def test_set_state_invalid_entity_id_raises(hass_driver, entity):
+    with pytest.raises(ValueError):
+        hass_driver.set_state(entity, "on")
+
+
 def test_listen_state(hass_driver):
     listen_state = hass_driver.get_mock("listen_state")
     handler1 = mock.Mock()
@@ -141,6 +184,32 @@ def test_listen_state_with_old(hass_driver):
         "media_player.smart_tv", "source", "Spotify", "TV", {}
     )
 
+def test_listen_state_kwargs_are_not_shared_between_calls(hass_driver):
+    listen_state = hass_driver.get_mock("listen_state")
+    received = []
+
+    def handler(entity, attribute, old, new, kwargs):
+        received.append(dict(kwargs))
+        with pytest.raises(TypeError):
+            kwargs["poison"] = 1
+
+    listen_state(handler, "light.1", foo=1)
+    listen_state(handler, "light.1")
+
+    hass_driver.set_state("light.1", "on")
+    hass_driver.set_state("light.1", "off", extra=2)
+    hass_driver.set_state("light.1", "on")
+
+    assert received == [
+        {"foo": 1},
+        {},
+        {"foo": 1, "extra": 2},
+        {"extra": 2},
+        {"foo": 1},
+        {},
+    ]
+
+
 def test_listen_state_should_return_handle(hass_driver):
     listen_state = hass_driver.get_mock("listen_state")
     handler = mock.Mock()
@@ -165,6 +234,157 @@ def test_setup_does_not_trigger_spys(hass_driver):
     assert handler.call_count == 1
 
 
+def test_batched_notifications_coalesce_changes(hass_driver):
+    listen_state = hass_driver.get_mock("listen_state")
+    get_state = hass_driver.get_mock("get_state")
+    handler = mock.Mock()
+    listen_state(handler, "light.1")
+    listen_state(handler, "light.1", attribute="linkquality")
+
+    with hass_driver.batched_notifications():
+        hass_driver.set_state("light.1", "on")
+        hass_driver.set_state("light.1", 40, attribute_name="linkquality")
+        hass_driver.set_state("light.1", 50, attribute_name="linkquality")
+
+        assert handler.call_count == 0
+        assert get_state("light.1") == "on"
+
+    assert handler.call_count == 2
+    handler.assert_has_calls(
+        [
+            mock.call("light.1", "state", "off", "on", {}),
+            mock.call("light.1", "linkquality", 60, 50, {}),
+        ]
+    )
+
+
+def test_batched_notifications_skip_reverted_changes(hass_driver):
+    listen_state = hass_driver.get_mock("listen_state")
+    handler = mock.Mock()
+    listen_state(handler, "light.1")
+
+    with hass_driver.batched_notifications():
+        hass_driver.set_state("light.1", "on")
+        hass_driver.set_state("light.1", "off")
+
+    assert handler.call_count == 0
+
+
+def test_batched_notifications_attribute_all(hass_driver):
+    listen_state = hass_driver.get_mock("listen_state")
+    handler = mock.Mock()
+    listen_state(handler, "light.1", attribute="all")
+
+    with hass_driver.batched_notifications():
+        hass_driver.set_state("light.1", "on")
+
+    handler.assert_called_once_with(
+        "light.1",
+        None,
+        {"state": "off", "linkquality": 60},
+        {"state": "on", "linkquality": 60},
+        {},
+    )
+
+
+def test_batched_notifications_attribute_all_called_once_per_entity(hass_driver):
+    listen_state = hass_driver.get_mock("listen_state")
+    handler = mock.Mock()
+    listen_state(handler, "light", attribute="all")
+
+    with hass_driver.batched_notifications():
+        hass_driver.set_state("light.1", "on")
+        hass_driver.set_state("light.1", 75, attribute_name="brightness")
+        hass_driver.set_state("light.2", "off")
+
+    assert handler.call_count == 2
+    handler.assert_has_calls(
+        [
+            mock.call(
+                "light.1",
+                None,
+                {"state": "off", "linkquality": 60},
+                {"state": "on", "linkquality": 60, "brightness": 75},
+                {},
+            ),
+            mock.call(
+                "light.2",
+                None,
+                {"state": "on", "linkquality": 10, "brightness": 60},
+                {"state": "off", "linkquality": 10, "brightness": 60},
+                {},
+            ),
+        ]
+    )
+
+
+def test_batched_notifications_are_reset_on_error(hass_driver):
+    listen_state = hass_driver.get_mock("listen_state")
+    handler = mock.Mock()
+    listen_state(handler, "light.1")
+
+    with pytest.raises(RuntimeError):
+        with hass_driver.batched_notifications():
+            hass_driver.set_state("light.1", "on")
+            raise RuntimeError()
+
+    assert handler.call_count == 0
+    hass_driver.set_state("light.1", "off")
+    handler.assert_called_once_with("light.1", "state", "on", "off", {})
+
+
+def test_batched_notifications_report_untriggered_changes_to_pending_values(
+    hass_driver,
+):
+    listen_state = hass_driver.get_mock("listen_state")
+    get_state = hass_driver.get_mock("get_state")
+    handler = mock.Mock()
+    listen_state(handler, "light.1")
+
+    with hass_driver.batched_notifications():
+        hass_driver.set_state("light.1", "on")
+        hass_driver.set_state("light.1", "dim", trigger=False)
+
+    assert get_state("light.1") == "dim"
+    handler.assert_called_once_with("light.1", "state", "off", "dim", {})
+
+
+def test_batched_notifications_drop_changes_reverted_during_setup(hass_driver):
+    listen_state = hass_driver.get_mock("listen_state")
+    handler = mock.Mock()
+    listen_state(handler, "light.1")
+
+    with hass_driver.batched_notifications():
+        hass_driver.set_state("light.1", "on")
+        with hass_driver.setup():
+            hass_driver.set_state("light.1", "off")
+
+    assert handler.call_count == 0
+
+
+def test_nested_batched_notifications_flush_at_outermost_exit(hass_driver):
+    listen_state = hass_driver.get_mock("listen_state")
+    handler = mock.Mock()
+    listen_state(handler, "light.1")
+    listen_state(handler, "light.2")
+
+    with hass_driver.batched_notifications():
+        with hass_driver.batched_notifications():
+            hass_driver.set_state("light.1", "on")
+
+        assert handler.call_count == 0
+        hass_driver.set_state("light.2", "off")
+        assert handler.call_count == 0
+
+    assert handler.call_count == 2
+    handler.assert_has_calls(
+        [
+            mock.call("light.1", "state", "off", "on", {}),
+            mock.call("light.2", "state", "on", "off", {}),
+        ]
+    )
+
+
 @pytest.mark.parametrize('update_state', [True, False])
 def test_turn_on_does_change_state_if_wanted(hass_driver, my_logging_app, update_state):
     hass_driver.update_states = update_state
@@ -217,9 +437,13 @@ def test_log(hass_driver, my_logging_app: MyLoggingApp):
 def hass_driver() -> HassDriver:
     hass_driver = HassDriver()
     hass_driver.inject_mocks()
-    hass_driver._states = {
+    states = {
         "light.1": {"state": "off", "linkquality": 60},
         "light.2": {"state": "on", "linkquality": 10, "brightness": 60},
         "media_player.smart_tv": {"state": "on", "source": None},
     }
+    with hass_driver.setup():
+        for entity, attributes in states.items():
+            for attribute_name, value in attributes.items():
+                hass_driver.set_state(entity, value, attribute_name=attribute_name)
     return hass_driver
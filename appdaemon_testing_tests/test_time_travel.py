@@ -125,6 +125,8 @@ def test_should_run_provided_method_with_args_on_timetravel(hass_driver, args):
                      id="run_every 20sec starting 12:10, jump to 12:11"),
         pytest.param(BASE_DATE_ADD_10, 20, BASE_DATE_ADD_10 + timedelta(seconds=59), 3,
                      id="run_every 20sec starting 12:10, jump to 12:10:59"),
+        pytest.param(BASE_DATE_ADD_10, 1.5, BASE_DATE_ADD_10 + timedelta(seconds=6), 5,
+                     id="run_every 1.5sec starting 12:10, jump to 12:10:06"),
     ]
 )
 def test_should_run_callback_every_x_seconds(hass_driver, start: datetime, interval_sec: int, jump_to: datetime,
@@ -275,6 +277,22 @@ def test_appdaemon_time_methods_should_be_mocked(hass_driver):
     assert _date() == BASE_DATE.date()
 
 
+def test_appdaemon_time_methods_should_follow_timetravel(hass_driver):
+    # ASSEMBLE
+    _time = hass_driver.get_mock("time")
+    _datetime = hass_driver.get_mock("datetime")
+    _date = hass_driver.get_mock("date")
+    new_time = BASE_DATE + timedelta(days=1, minutes=10)
+
+    # ACT
+    hass_driver.time_travel_to(new_time)
+
+    # ASSERT
+    assert _time() == new_time.time()
+    assert _datetime() == new_time
+    assert _date() == new_time.date()
+
+
 @pytest.mark.parametrize(
     "add_minutes",
     [
@@ -364,6 +382,93 @@ def test_should_cancel_timer(hass_driver):
     assert my_value == 0
 
 
+def test_should_cancel_repeating_timer(hass_driver):
+    # ASSEMBLE
+    my_value = 0
+
+    def my_callback(**kwargs):
+        nonlocal my_value
+        my_value += 1
+
+    run_every = hass_driver.get_mock("run_every")
+    cancel_timer = hass_driver.get_mock("cancel_timer")
+    handle = run_every(my_callback, BASE_DATE_ADD_10, 300)
+    hass_driver.time_travel_to(BASE_DATE_ADD_10)
+    assert my_value == 1
+
+    # ACT
+    cancel_timer(handle)
+    hass_driver.time_travel_to(BASE_DATE + timedelta(minutes=30))
+
+    # ASSERT
+    assert my_value == 1
+
+
+def test_repeating_timer_started_in_the_past_should_only_run_in_the_future(hass_driver):
+    # ASSEMBLE
+    my_value = 0
+
+    def my_callback(**kwargs):
+        nonlocal my_value
+        my_value += 1
+
+    run_every = hass_driver.get_mock("run_every")
+
+    # runs at 11:59:55 (before the simulation start), 12:00:05, 12:00:15, ...
+    run_every(my_callback, BASE_DATE - timedelta(seconds=5), 10)
+
+    # ACT / ASSERT
+    hass_driver.time_travel_to(BASE_DATE + timedelta(seconds=10))
+    assert my_value == 1
+
+    hass_driver.time_travel_to(BASE_DATE + timedelta(seconds=20))
+    assert my_value == 2
+
+
+def test_repeating_timer_should_run_once_per_jump_landing_on_run_time(hass_driver):
+    # ASSEMBLE
+    my_value = 0
+
+    def my_callback(**kwargs):
+        nonlocal my_value
+        my_value += 1
+
+    run_every = hass_driver.get_mock("run_every")
+    run_every(my_callback, BASE_DATE + timedelta(seconds=10), 10)
+
+    # ACT / ASSERT
+    for seconds, expected in [(10, 1), (15, 1), (20, 2), (30, 3), (31, 3), (40, 4)]:
+        hass_driver.time_travel_to(BASE_DATE + timedelta(seconds=seconds))
+        assert my_value == expected
+
+
+def test_scheduling_with_string_start_should_register_but_not_time_travel(hass_driver):
+    # ASSEMBLE
+    run_daily = hass_driver.get_mock("run_daily")
+
+    # ACT
+    handle = run_daily(lambda **kwargs: None, "07:00:00")
+
+    # ASSERT
+    assert uuid.UUID(handle)
+    with pytest.raises(ValueError):
+        hass_driver.time_travel_to(BASE_DATE_ADD_10)
+
+
+def test_canceled_timer_with_string_start_should_not_block_time_travel(hass_driver):
+    # ASSEMBLE
+    run_daily = hass_driver.get_mock("run_daily")
+    cancel_timer = hass_driver.get_mock("cancel_timer")
+    handle = run_daily(lambda **kwargs: None, "07:00:00")
+
+    # ACT
+    cancel_timer(handle)
+    hass_driver.time_travel_to(BASE_DATE_ADD_10)
+
+    # ASSERT
+    assert hass_driver.simulation_time == BASE_DATE_ADD_10
+
+
 def test_should_call_multiple_timers_of_different_kinds(hass_driver):
     my_value1 = 0
     my_value2 = 0
@@ -440,6 +545,24 @@ def test_should_call_multiple_timers_of_same_kind(hass_driver):
     assert my_value == 6
 
 
+def test_callbacks_due_at_the_same_time_should_run_in_registration_order(hass_driver):
+    # ASSEMBLE
+    calls = []
+    run_every = hass_driver.get_mock("run_every")
+    run_at = hass_driver.get_mock("run_at")
+
+    run_every(lambda **kwargs: calls.append("A"), BASE_DATE + timedelta(seconds=5), 5)
+    run_at(lambda **kwargs: calls.append("B"), BASE_DATE + timedelta(seconds=10))
+    run_every(lambda **kwargs: calls.append("C"), BASE_DATE + timedelta(seconds=1), 9)
+
+    # ACT
+    hass_driver.time_travel_to(BASE_DATE + timedelta(seconds=10))
+
+    # ASSERT
+    # C at 1s, A at 5s, then A, B and C all at 10s
+    assert calls == ["C", "A", "A", "B", "C"]
+
+
 @pytest.mark.parametrize(
     "missing_test",
     [